@@ -1,41 +1,247 @@
 import os
-import secrets
+import gzip
+import html
+import time
+import pickle
+import httpx
+import jinja2
+import hashlib
 import markdown
 import asyncio
+import mimetypes
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from functools import cache, lru_cache
+from pathlib import Path
+from weakref import WeakValueDictionary
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Form
+from fastapi import FastAPI, Request, Form, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse
+from starlette.datastructures import Headers
+from sse_starlette.sse import EventSourceResponse
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import trim_messages
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Load environment variables
 load_dotenv()
 
 app = FastAPI()
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+class CachedStaticFiles(StaticFiles):
+    """Serve static assets from memory with precompressed bodies.
+
+    Files are read once at startup, so the hot path never stats or hashes on
+    disk; responses carry a strong ETag and a precomputed gzip (and brotli,
+    if available) body chosen by Accept-Encoding. Unknown paths fall through
+    to the stock StaticFiles.
+    """
+
+    # Paths here are plain filenames, not content-fingerprinted URLs, so
+    # browsers must revalidate on each use; 304s are answered from memory.
+    # An immutable year-long policy would hide asset edits from returning
+    # clients until their cache expired.
+    _CACHE_CONTROL = "public, no-cache"
+
+    def __init__(self, *, directory: str, max_file_size: int = 2 * 1024 * 1024, **kwargs):
+        super().__init__(directory=directory, check_dir=False, **kwargs)
+        self._cache = {}
+        root = Path(directory)
+        self._has_directory = root.is_dir()
+        if self._has_directory:
+            for path in root.rglob("*"):
+                if not path.is_file() or path.stat().st_size > max_file_size:
+                    continue
+                body = path.read_bytes()
+                self._cache[path.relative_to(root).as_posix()] = (
+                    body,
+                    f'"{hashlib.md5(body).hexdigest()}"',
+                    gzip.compress(body),
+                    brotli.compress(body) if brotli else None,
+                    mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+                )
+
+    async def get_response(self, path: str, scope) -> Response:
+        entry = self._cache.get(path)
+        if entry is None:
+            if not self._has_directory:
+                # Stock StaticFiles' first-request check_config stats the
+                # directory regardless of check_dir and raises RuntimeError
+                # (a 500) when it's missing; just say the file isn't here.
+                return Response(status_code=404)
+            return await super().get_response(path, scope)
+        body, etag, gz_body, br_body, media_type = entry
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self._CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+        request_headers = Headers(scope=scope)
+        if request_headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        accept_encoding = request_headers.get("accept-encoding", "")
+        if br_body is not None and "br" in accept_encoding and len(br_body) < len(body):
+            headers["Content-Encoding"] = "br"
+            body = br_body
+        elif "gzip" in accept_encoding and len(gz_body) < len(body):
+            headers["Content-Encoding"] = "gzip"
+            body = gz_body
+        return Response(content=body, media_type=media_type, headers=headers)
+
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+# Non-reloading Jinja environment: no per-render stat/mtime check, unbounded
+# compiled-template cache, warmed below so no request pays parse cost.
+_jinja_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    auto_reload=False,
+    cache_size=-1,
+    autoescape=jinja2.select_autoescape(["html"]),
+)
+templates = Jinja2Templates(env=_jinja_env)
+for _name in _jinja_env.list_templates():
+    _jinja_env.get_template(_name)
+
+# Initialize LangChain lazily: importing this module (e.g. in a markdown
+# worker process) shouldn't pay for OpenAI client construction.
+@cache
+def get_model():
+    if not os.getenv("OPENAI_API_KEY"):
+        print("WARNING: OPENAI_API_KEY not found. Chat will fail.")
+        return None
+    # One pooled HTTP/2 client shared by every request: warm, multiplexed
+    # connections to api.openai.com instead of a TLS handshake per chat.
+    oai_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    )
+    return ChatOpenAI(model="gpt-3.5-turbo", streaming=True, http_async_client=oai_client)
+
+# Reverse proxies buffer text/event-stream unless told otherwise; set the
+# nginx escape hatch and caching headers explicitly rather than relying on
+# sse-starlette's defaults (which vary by version).
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+# One-pass escape table for streamed plaintext (C-speed via str.translate,
+# vs. one full pass and allocation per html.escape/replace call).
+_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\n": "<br>"})
+
+# Invariant SSE events, built once instead of per yield in the hot loop.
+_EVT_START = {"event": "start", "data": "<!-- -->"}
+_EVT_CLEAR_TAIL = {"event": "tail", "data": "<!-- -->"}
+_EVT_CLOSE = {"event": "close", "data": ""}
 
-# Initialize LangChain
-if os.getenv("OPENAI_API_KEY"):
-    model = ChatOpenAI(model="gpt-3.5-turbo", streaming=True)
-else:
-    print("WARNING: OPENAI_API_KEY not found. Chat will fail.")
-    model = None
+# The invariant OOB swap markup is formatted once here; only the message id
+# and payload vary per stream.
+_FINAL_TEMPLATE = (
+    '<div id="bot-response-{mid}" hx-swap-oob="outerHTML" '
+    'class="bg-gray-200 text-gray-800 rounded-lg px-4 py-2 max-w-[80%] prose">{html}</div>'
+).format
+_ERROR_TEMPLATE = (
+    '<div id="bot-response-{mid}" hx-swap-oob="outerHTML" '
+    'class="bg-gray-200 text-gray-800 rounded-lg px-4 py-2 max-w-[80%] prose border border-red-500">{msg}</div>'
+).format
 
-# Memory Storage (In-Memory for simplicity)
-store = {}
+# Single Markdown instance so extensions (incl. Pygments via codehilite)
+# are only registered once; reset() clears its per-document state. Renders
+# run both on the event loop and in to_thread workers, and the instance is
+# stateful, so conversion is serialized behind a lock.
+_MD = markdown.Markdown(extensions=['fenced_code', 'codehilite'], output_format='html5')
+_MD_LOCK = threading.Lock()
 
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+@lru_cache(maxsize=256)
+def _render_markdown(text: str) -> str:
+    with _MD_LOCK:
+        _MD.reset()
+        return _MD.convert(text)
+
+# Pygments lexers are pure Python and CPU-heavy on big code blocks, so
+# responses with fenced code render in a worker process (where
+# _render_markdown keeps its own per-process instance and cache). Workers
+# are only spawned on first use.
+_MD_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Memory Storage: bounded LRU of sessions, cold sessions spilled to disk
+class SessionStore:
+    def __init__(self, capacity: int = 1024, spill_dir: str = "./sess"):
+        self.capacity = capacity
+        self.spill_dir = Path(spill_dir)
+        self._sessions: "OrderedDict[str, ChatMessageHistory]" = OrderedDict()
+        self._locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+
+    def get(self, session_id: str) -> ChatMessageHistory:
+        history = self._sessions.get(session_id)
+        if history is None:
+            history = self._load(session_id) or ChatMessageHistory()
+            self._sessions[session_id] = history
+            if len(self._sessions) > self.capacity:
+                old_id, old_history = self._sessions.popitem(last=False)
+                self._dump(old_id, old_history)
+        else:
+            self._sessions.move_to_end(session_id)
+        # Bound per-prompt token cost: gut old messages once a session gets long.
+        if len(history.messages) > 30:
+            history.messages[:] = history.messages[-10:]
+        return history
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        # Weakly cached so locks for idle sessions are collected automatically;
+        # callers hold a strong reference for the duration of `async with`.
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    def _path(self, session_id: str) -> Path:
+        # Session ids come straight from client cookies; hash them so they
+        # can never traverse or collide with anything else on disk.
+        return self.spill_dir / hashlib.sha256(session_id.encode()).hexdigest()
+
+    def _load(self, session_id: str):
+        path = self._path(session_id)
+        try:
+            with path.open("rb") as f:
+                history = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated or unpicklable spill (EOFError, AttributeError, ...);
+            # drop the file so the session can start fresh instead of failing
+            # on every subsequent access.
+            path.unlink(missing_ok=True)
+            return None
+        path.unlink(missing_ok=True)
+        return history
+
+    def _dump(self, session_id: str, history: ChatMessageHistory):
+        try:
+            self.spill_dir.mkdir(exist_ok=True)
+            with self._path(session_id).open("wb") as f:
+                pickle.dump(history, f)
+        except (OSError, pickle.PickleError):
+            pass  # Worst case the cold session starts fresh on its next visit.
+
+store = SessionStore()
+
+# Bound method used directly: no extra wrapper frame on every history lookup.
+get_session_history = store.get
 
 PROMPT = ChatPromptTemplate.from_messages([
     ("system", "You are a helpful assistant. Result must be in markdown."),
@@ -43,9 +249,27 @@ PROMPT = ChatPromptTemplate.from_messages([
     ("human", "{question}"),
 ])
 
-if model:
-    chain = PROMPT | model | StrOutputParser()
-    runnable_with_history = RunnableWithMessageHistory(
+def _trim_history(inputs: dict) -> dict:
+    # Cap what we actually send: keep the most recent turns under a token
+    # budget so prompt size (and provider cost) stays bounded per turn.
+    return {
+        **inputs,
+        "history": trim_messages(
+            inputs["history"],
+            max_tokens=2000,
+            token_counter=get_model(),
+            strategy="last",
+            include_system=True,
+        ),
+    }
+
+@cache
+def get_runnable():
+    model = get_model()
+    if model is None:
+        return None
+    chain = RunnableLambda(_trim_history) | PROMPT | model | StrOutputParser()
+    return RunnableWithMessageHistory(
         chain,
         get_session_history,
         input_messages_key="question",
@@ -55,20 +279,34 @@ if model:
 @app.get("/", response_class=HTMLResponse)
 async def get(request: Request):
     # Ensure session_id exists
-    session_id = request.cookies.get("session_id")
     response = templates.TemplateResponse("index.html", {"request": request})
-    if not session_id:
-        response.set_cookie("session_id", secrets.token_hex(16))
+    if not request.cookies.get("session_id"):
+        # os.urandom feeds secrets.token_hex anyway; skip the SystemRandom wrapper.
+        response.set_cookie("session_id", os.urandom(16).hex())
     return response
 
+# User messages awaiting their stream connection, keyed by message_id. This
+# keeps the message out of the SSE URL (nginx caps URLs at 8 KB by default,
+# and query strings leak into access logs). Stale entries are dropped lazily
+# on insert.
+_PENDING: "dict[str, tuple[float, str]]" = {}
+_PENDING_TTL = 60.0
+
+def _stash_pending(message_id: str, message: str):
+    now = time.monotonic()
+    for stale in [mid for mid, (ts, _) in _PENDING.items() if now - ts > _PENDING_TTL]:
+        del _PENDING[stale]
+    _PENDING[message_id] = (now, message)
+
 @app.post("/chat", response_class=HTMLResponse)
 async def chat(request: Request, message: str = Form(...)):
     session_id = request.cookies.get("session_id")
     if not session_id:
          session_id = "default"
-    
+
     # Generate a unique ID for this message bubble
-    message_id = secrets.token_hex(4)
+    message_id = os.urandom(4).hex()
+    _stash_pending(message_id, message)
 
     return templates.TemplateResponse("chat_response_fragment.html", {
         "request": request,
@@ -77,50 +315,238 @@ async def chat(request: Request, message: str = Form(...)):
         "message_id": message_id
     })
 
+async def _coalesce(stream, window: float = 0.016, max_len: int = 64):
+    # OpenAI emits lots of 1-3 char chunks; each one shipped alone costs a
+    # full SSE frame, HTTP chunk, and browser reflow. Merge chunks until the
+    # flush window (started by the first buffered chunk) lapses or the buffer
+    # is worth sending. The stream is drained through a queue so the window
+    # is a real timer: buffered text flushes when it expires even if the
+    # model stalls mid-stream.
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def _drain():
+        try:
+            async for chunk in stream:
+                if chunk:
+                    queue.put_nowait(chunk)
+            queue.put_nowait(None)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    drain_task = asyncio.create_task(_drain())
+    buf = ""
+    deadline = None
+    try:
+        while True:
+            if deadline is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    yield buf
+                    buf, deadline = "", None
+                    continue
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            buf += item
+            if deadline is None:
+                deadline = loop.time() + window
+            if len(buf) >= max_len:
+                yield buf
+                buf, deadline = "", None
+        if buf:
+            yield buf
+    finally:
+        drain_task.cancel()
+
+def _error_events(message_id: str, msg: str):
+    # A single OOB frame both shows the error and removes the sse-connect
+    # attribute, so a persistent failure can't turn into a reconnect storm of
+    # duplicated error frames.
+    yield {"event": "message", "data": _ERROR_TEMPLATE(mid=message_id, msg=html.escape(msg, quote=False))}
+    yield _EVT_CLOSE
+
 async def stream_generator(session_id: str, message: str, message_id: str):
-    if not model or not message:
-        yield f"event: message\ndata: <div class='text-red-500'>Error: API Key missing</div>\n\n"
-        # Stop everything by replacing with static error via OOB
-        yield f"""event: message
-data: <div id="bot-response-{message_id}" hx-swap-oob="outerHTML" class="bg-gray-200 text-gray-800 rounded-lg px-4 py-2 max-w-[80%] prose border border-red-500">Error: API Key missing</div>
-"""
-        yield "event: close\ndata: \n\n"
+    runnable = get_runnable()
+    if runnable is None:
+        for event in _error_events(message_id, "Error: API Key missing"):
+            yield event
+        return
+    if not message:
+        # The _PENDING entry expired before the stream connected.
+        for event in _error_events(message_id, "Error: message expired, please resend"):
+            yield event
         return
 
     full_response = ""
-    
+    pending = ""
+    started = False
+
     try:
-        async for chunk in runnable_with_history.astream(
-            {"question": message},
-            config={"configurable": {"session_id": session_id}}
-        ):
-            full_response += chunk
-            safe_text = full_response.replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br>")
-            yield f"event: message\ndata: {safe_text}\n\n"
-            
+        # Serialize streams per session so concurrent requests can't
+        # interleave writes into the same ChatMessageHistory.
+        async with store.lock(session_id):
+            async for chunk in _coalesce(runnable.astream(
+                {"question": message},
+                config={"configurable": {"session_id": session_id}}
+            )):
+                full_response += chunk
+                pending += chunk
+                if not started:
+                    # Remove the "Thinking..." placeholder on the first token.
+                    yield _EVT_START
+                    started = True
+                # Commit up to the last safe block boundary in the buffer: a
+                # blank line with no fence left open before it. Coalesced
+                # chunks routinely carry a boundary mid-buffer, so scanning
+                # backwards (rather than requiring the buffer to *end* on one)
+                # is what makes incremental rendering actually fire. Fences
+                # never span commits, so counting ``` in pending is enough.
+                boundary = pending.rfind("\n\n")
+                while boundary != -1 and pending.count("```", 0, boundary) % 2:
+                    boundary = pending.rfind("\n\n", 0, boundary)
+                if boundary != -1:
+                    block_html = _render_markdown(pending[:boundary + 2])
+                    pending = pending[boundary + 2:]
+                    yield {"event": "append", "data": block_html}
+                if pending:
+                    # Only the (small) unfinished block streams as escaped text.
+                    yield {"event": "tail", "data": pending.translate(_ESC)}
+                else:
+                    yield _EVT_CLEAR_TAIL
+
         # Final Step: Replace the headers entirely using OOB to stop reconnection
-        rendered_html = markdown.markdown(full_response, extensions=['fenced_code', 'codehilite'])
+        if "```" in full_response:
+            # Syntax highlighting is the expensive part; pay the IPC cost only
+            # when there is actually code to highlight.
+            rendered_html = await asyncio.get_running_loop().run_in_executor(
+                _MD_POOL, _render_markdown, full_response
+            )
+        elif len(full_response) > 4096:
+            rendered_html = await asyncio.to_thread(_render_markdown, full_response)
+        else:
+            rendered_html = _render_markdown(full_response)
         safe_rendered_html = rendered_html.replace("\n", "")
-        
+
         # OOB Swap to replace the streaming container with a static one
         # This removes the 'sse-connect' attribute, preventing reconnection.
-        yield f"""event: message
-data: <div id="bot-response-{message_id}" hx-swap-oob="outerHTML" class="bg-gray-200 text-gray-800 rounded-lg px-4 py-2 max-w-[80%] prose">{safe_rendered_html}</div>
-"""
-        yield "event: close\ndata: \n\n"
-        
+        yield {"event": "message", "data": _FINAL_TEMPLATE(mid=message_id, html=safe_rendered_html)}
+        yield _EVT_CLOSE
+
     except Exception as e:
-        yield f"event: message\ndata: Error: {str(e)}\n\n"
-        yield "event: close\ndata: \n\n"
+        for event in _error_events(message_id, f"Error: {e}"):
+            yield event
+
+class _Broadcast:
+    """One in-flight LLM stream fanned out to any number of SSE subscribers."""
+
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+        self.started = False
+        self.committed: "list[str]" = []  # rendered blocks appended so far
+        self.tail = None                  # latest tail frame, if any
+        self.final: "list[dict]" = []     # terminal frames (OOB swap + close)
+        self.queues: "list[asyncio.Queue]" = []
+        self.done = False
+        self.done_at = None
+        self.task = None
+
+    def publish(self, event: dict):
+        # Keep a snapshot of the client-visible state rather than the raw
+        # event log: replaying raw 'append' events to a reconnecting client
+        # would duplicate every committed block in its DOM.
+        name = event["event"]
+        if name == "start":
+            self.started = True
+        elif name == "append":
+            self.committed.append(event["data"])
+        elif name == "tail":
+            self.tail = event
+        else:
+            self.final.append(event)
+        for queue in self.queues:
+            queue.put_nowait(event)
+
+    def finish(self):
+        self.done = True
+        for queue in self.queues:
+            queue.put_nowait(None)
+
+    def _snapshot(self):
+        if self.final:
+            # The final OOB swap replaces the whole bubble; nothing else needed.
+            yield from self.final
+            return
+        if self.started:
+            yield _EVT_START
+        if self.committed:
+            # OOB innerHTML swap resets the committed area wholesale, which is
+            # idempotent whatever the reconnecting client already has.
+            yield {
+                "event": "message",
+                "data": f'<span id="committed-{self.message_id}" hx-swap-oob="innerHTML">{"".join(self.committed)}</span>',
+            }
+        if self.tail is not None:
+            yield self.tail
+
+    async def subscribe(self):
+        if self.done:
+            for event in self._snapshot():
+                yield event
+            return
+        queue: asyncio.Queue = asyncio.Queue()
+        self.queues.append(queue)
+        try:
+            # The snapshot reflects state strictly before queue registration
+            # (no await in between), so the live tail can't duplicate it.
+            for event in list(self._snapshot()):
+                yield event
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.queues.remove(queue)
+
+# In-flight streams keyed by (session_id, message_id): an htmx SSE reconnect
+# (or a duplicate tab) tails the existing generation instead of paying for a
+# second LLM call. Finished broadcasts linger briefly so a client that
+# dropped mid-stream and reconnects after completion still replays the
+# terminal frames instead of finding nothing; stale ones are swept lazily
+# when a new stream starts, like _PENDING.
+_broadcasters: "dict[tuple[str, str], _Broadcast]" = {}
+_BROADCAST_TTL = 60.0
+
+async def _drive_stream(key, session_id: str, message: str, message_id: str):
+    cast = _broadcasters[key]
+    try:
+        async for event in stream_generator(session_id, message, message_id):
+            cast.publish(event)
+    finally:
+        cast.finish()
+        cast.done_at = time.monotonic()
 
 @app.get("/chat_stream/{session_id}")
 async def chat_stream(request: Request, session_id: str):
-    message = request.query_params.get("message", "")
     message_id = request.query_params.get("message_id", "")
-    return StreamingResponse(
-        stream_generator(session_id, message, message_id),
-        media_type="text/event-stream"
-    )
+    key = (session_id, message_id)
+    cast = _broadcasters.get(key)
+    if cast is None:
+        now = time.monotonic()
+        for stale in [k for k, c in _broadcasters.items()
+                      if c.done_at is not None and now - c.done_at > _BROADCAST_TTL]:
+            del _broadcasters[stale]
+        _, message = _PENDING.pop(message_id, (0.0, ""))
+        cast = _broadcasters[key] = _Broadcast(message_id)
+        cast.task = asyncio.create_task(
+            _drive_stream(key, session_id, message, message_id)
+        )
+    return EventSourceResponse(cast.subscribe(), ping=20, headers=_SSE_HEADERS)
 
 @app.post("/chat/user", response_class=HTMLResponse)
 async def chat_user(request: Request, message: str = Form(...)):